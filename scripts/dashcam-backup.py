@@ -12,125 +12,444 @@ __date__        = "2024-12-31"
 __license__     = "BSD 3-Clause License"
 __version__     = "1.0.2"
 
-import os, platform, shutil
-import argparse
+import os, platform, stat, sys
+import argparse, ctypes, errno, fcntl, queue, struct, subprocess, threading
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import List
+from typing import Dict, Iterator, List, Optional, Tuple
+
+_ROOT = "TeslaCam"
+_SUB_DIRS = ("RecentClips", "SavedClips", "SentryClips")
+
+# Listing indentation by depth, two spaces per level.
+_INDENTS = tuple("  " * level for level in range(64))
+
+# Upper bound for a single kernel-side copy call, mirrors CPython's own fast-copy loop.
+_COPY_CHUNK_SIZE = 2 ** 30
+
+# Userspace fallback buffers, one read and one write per MiB instead of per 64 KiB.
+# Two buffers let the next read overlap the current write.
+_FALLBACK_BUFFER_SIZE = 1 << 20
+_FALLBACK_BUFFER_COUNT = 2
+
+# fcopyfile(3) flag to copy only the data fork, metadata is restored afterwards.
+_COPYFILE_DATA = 1 << 3
+
+# fcntl(2) F_PREALLOCATE request and fstore_t flags on macOS, not exposed by the fcntl module.
+_F_PREALLOCATE = 42
+_F_ALLOCATECONTIG = 0x2
+_F_ALLOCATEALL = 0x4
+_F_PEOFPOSMODE = 3
+
+# fallocate(2) mode on Linux that reserves blocks without changing st_size or zero-filling the file.
+_FALLOC_FL_KEEP_SIZE = 0x1
+
+# Errors meaning the kernel copy is not supported for this pair of files, rather than a real I/O failure.
+_KERNEL_COPY_FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTSOCK, errno.EBADF)
+
+# Mtimes within this window count as equal, FAT32 stores them to 2 s, HFS+ to 1 s and exFAT to 10 ms.
+_MTIME_WINDOW_NS = 2 * 10 ** 9
+
+# Past four workers the copies start contending on the per-volume directory lock.
+_COPY_WORKERS = 4
+
+# Tesla only writes clips, thumbnails and event metadata under TeslaCam.
+_ACCEPT_SUFFIXES = (".mp4", ".png", ".json")
+
+_libsystem = ctypes.CDLL("/usr/lib/libSystem.dylib", use_errno=True) if platform.system() == "Darwin" else None
+
+_libc = ctypes.CDLL(None, use_errno=True) if platform.system() == "Linux" else None
+
+_has_fadvise = hasattr(os, "posix_fadvise")
+
+if _libsystem is not None:
+    _libsystem.clonefile.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint32]
+    _libsystem.clonefile.restype = ctypes.c_int
+
+if _libc is not None:
+    _libc.fallocate64.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    _libc.fallocate64.restype = ctypes.c_int
 
 class DashcamBackup:
     """This script is used to backup the USB Tesla DashCam drives to a backup drive. Currently supports MacOS and Linux."""
 
-    def __init__(self, source: str, destination: str, verbose: bool = False):
+    def __init__(self, source: str, destination: str, verbose: bool = False, accept_suffixes: Tuple[str, ...] = _ACCEPT_SUFFIXES, use_cp: bool = False):
         self.source = source
         self.destination = destination
         self.verbose = verbose
+        self.use_cp = use_cp
+        self._accept_suffixes = accept_suffixes
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._log: List[str] = []
+        self._skipped = 0
+        self._device_cache: Dict[str, int] = {}
 
     def run(self):
-        root_directory = self.__root_directory()
+        source_root = os.path.join(self.source, _ROOT)
+        destination_root = os.path.join(self.destination, _ROOT)
 
         if self.verbose:
             print(f"Backing up from {self.source} to {self.destination}")
 
-        for sub_directory in self.__sub_directories():
-            sub_path = f"{root_directory}/{sub_directory}"
-            source_path = f"{self.source}/{sub_path}"
-            destination_path = f"{self.destination}/{sub_path}"
+        if self.use_cp:
+            self.__run_sub_directories(source_root, destination_root)
+
+            return
+
+        self._pool = ThreadPoolExecutor(max_workers=_COPY_WORKERS)
 
-            self.__make_directory_if_not_exist(source_path, not_exist_message=f"Source path {source_path} does not exist", creation_message=f"Creating source path {source_path}")
-            self.__make_directory_if_not_exist(destination_path, not_exist_message=f"Destination path {destination_path} does not exist", creation_message=f"Creating destination path {destination_path}")
+        try:
+            self.__run_sub_directories(source_root, destination_root)
+        finally:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    def __run_sub_directories(self, source_root: str, destination_root: str):
+        for sub_directory in _SUB_DIRS:
+            source_path = os.path.join(source_root, sub_directory)
+            destination_path = os.path.join(destination_root, sub_directory)
+
+            if not self.__source_directory_exists(source_path, not_exist_message=f"Source path {source_path} does not exist, skipping"):
+                continue
+
+            self.__ensure_destination_directory(destination_path, creation_message=f"Created destination path {destination_path}")
 
             if self.verbose:
                 print(f"Processing {sub_directory} from {self.source} to {self.destination}")
 
-            number_of_entries_copied = 0
+            if self.use_cp:
+                self.__copy_with_cp(source_path, destination_path)
+                continue
 
-            for entry in os.scandir(source_path):
-                if entry.is_file():
-                    shutil.copy(entry.path, destination_path)
-                if entry.is_dir():
-                    next_destination_sub_directory = f"{destination_path}/{entry.name}"
+            copies: Dict[Future, str] = {}
+            self._skipped = 0
 
-                    if not os.path.exists(next_destination_sub_directory):
-                        os.mkdir(next_destination_sub_directory)
+            self.__copy_tree(source_path, destination_path, copies)
+            self.__flush_log()
+            self.__wait_for_copies(copies)
 
-                    for sub_entry in os.scandir(entry.path):
-                        if sub_entry.is_file():
-                            shutil.copy(sub_entry.path, next_destination_sub_directory)
-                        else:
-                            if self.verbose:
-                                print(f"Depth not supported for: {sub_entry.path}")
-                else:
-                    if self.verbose:
-                        print(f"Unknown entry type: {entry}")
+            if self.verbose:
+                print(f"Copied {len(copies)} files and skipped {self._skipped} already backed up from {source_path} to {destination_path}")
+
+    def __copy_with_cp(self, source_path: str, destination_path: str):
+        arguments = ["cp", "-p", "-R"]
 
-                number_of_entries_copied += 1
+        if _libsystem is not None:
+            arguments.append("-c")
 
-                if self.verbose:
-                    print(f"Copying {entry.path} to {destination_path}")
+        arguments += [os.path.join(source_path, "."), destination_path]
 
+        if self.verbose:
+            print(f"Running {' '.join(arguments)}")
+
+        pid = os.posix_spawn("/bin/cp", arguments, os.environ)
+        _, status = os.waitpid(pid, 0)
+        exit_code = os.waitstatus_to_exitcode(status)
+
+        if exit_code != 0:
+            print(f"cp exited with status {exit_code} copying {source_path} to {destination_path}")
+
+            raise subprocess.CalledProcessError(exit_code, arguments)
+
+    def __copy_tree(self, source_directory: str, destination_directory: str, copies: Dict[Future, str]):
+        pending = deque([(source_directory, destination_directory)])
+
+        while pending:
+            source_path, destination_path = pending.popleft()
+
+            os.makedirs(destination_path, exist_ok=True)
+
+            for entry in self.__scan(source_path):
+                if entry.name.endswith(self._accept_suffixes):
+                    if entry.is_file(follow_symlinks=False):
+                        self.__submit_copy(entry, destination_path, copies)
+                    elif self.verbose:
+                        self._log.append(f"Skipping unsupported entry: {entry}")
+                elif entry.is_dir(follow_symlinks=False):
+                    pending.append((entry.path, os.path.join(destination_path, entry.name)))
+                elif self.verbose:
+                    self._log.append(f"Skipping unsupported entry: {entry}")
+
+    def __submit_copy(self, entry: os.DirEntry, destination_directory: str, copies: Dict[Future, str]):
+        destination_path = os.path.join(destination_directory, entry.name)
+
+        if not self.__needs_copy(entry, destination_path):
             if self.verbose:
-                print(f"Processed {number_of_entries_copied} entries from {source_path} to {destination_path}")
+                self._log.append(f"Skipping {entry.path}, already backed up")
+
+            self._skipped += 1
+
+            return
+
+        copies[self._pool.submit(self.__fastcopy, entry, destination_path)] = entry.path
+
+        if self.verbose:
+            self._log.append(f"Copying {entry.path} to {destination_path}")
+
+    def __needs_copy(self, entry: os.DirEntry, destination_path: str) -> bool:
+        try:
+            destination_stat = os.stat(destination_path)
+        except FileNotFoundError:
+            return True
+
+        source_stat = entry.stat(follow_symlinks=False)
+
+        return source_stat.st_size != destination_stat.st_size or abs(source_stat.st_mtime_ns - destination_stat.st_mtime_ns) > _MTIME_WINDOW_NS
+
+    def __flush_log(self):
+        if not self._log:
+            return
+
+        sys.stdout.write("\n".join(self._log))
+        sys.stdout.write("\n")
+        self._log.clear()
+
+    def __wait_for_copies(self, copies: Dict[Future, str]):
+        wait(copies)
+
+        errors = [(path, future.exception()) for future, path in copies.items() if future.exception() is not None]
+
+        for path, error in errors:
+            print(f"Failed to copy {path}: {error}")
+
+        if errors:
+            raise errors[0][1]
+
+    def __fastcopy(self, entry: os.DirEntry, destination_path: str):
+        source_stat = entry.stat(follow_symlinks=False)
+
+        if self.__clone(entry.path, destination_path, source_stat):
+            os.utime(destination_path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+
+            return
+
+        in_fd = os.open(entry.path, os.O_RDONLY)
+
+        try:
+            if _has_fadvise:
+                self.__advise(in_fd, os.POSIX_FADV_SEQUENTIAL)
+
+            out_fd = os.open(destination_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, source_stat.st_mode & 0o777)
+
+            try:
+                os.fchmod(out_fd, stat.S_IMODE(source_stat.st_mode))
+                self.__preallocate(out_fd, source_stat.st_size)
+
+                try:
+                    self.__copy_descriptor(in_fd, out_fd, source_stat.st_size)
+                except BaseException:
+                    os.unlink(destination_path)
+                    raise
+
+                if _has_fadvise:
+                    self.__advise(in_fd, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(out_fd)
+        finally:
+            os.close(in_fd)
+
+        os.utime(destination_path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+
+    def __clone(self, source_path: str, destination_path: str, source_stat: os.stat_result) -> bool:
+        if _libsystem is None or source_stat.st_dev != self.__device_of(os.path.dirname(destination_path)):
+            return False
+
+        try:
+            os.unlink(destination_path)
+        except FileNotFoundError:
+            pass
+
+        return _libsystem.clonefile(os.fsencode(source_path), os.fsencode(destination_path), 0) == 0
+
+    def __device_of(self, directory: str) -> int:
+        device = self._device_cache.get(directory)
+
+        if device is None:
+            device = os.stat(directory).st_dev
+            self._device_cache[directory] = device
+
+        return device
+
+    def __advise(self, fd: int, advice: int):
+        try:
+            os.posix_fadvise(fd, 0, 0, advice)
+        except OSError:
+            pass
+
+    def __preallocate(self, out_fd: int, size: int):
+        if size == 0:
+            return
+
+        if _libsystem is not None:
+            for flags in (_F_ALLOCATECONTIG | _F_ALLOCATEALL, _F_ALLOCATEALL):
+                try:
+                    fcntl.fcntl(out_fd, _F_PREALLOCATE, struct.pack("Iiqqq", flags, _F_PEOFPOSMODE, 0, size, 0))
+                    return
+                except OSError:
+                    continue
+        elif _libc is not None:
+            _libc.fallocate64(out_fd, _FALLOC_FL_KEEP_SIZE, 0, size)
+
+    def __copy_descriptor(self, in_fd: int, out_fd: int, size: int):
+        if _libsystem is not None and _libsystem.fcopyfile(in_fd, out_fd, None, _COPYFILE_DATA) == 0 and os.fstat(out_fd).st_size == size:
+            return
+
+        offset = 0
+
+        if hasattr(os, "copy_file_range"):
+            try:
+                while offset < size and (copied := os.copy_file_range(in_fd, out_fd, _COPY_CHUNK_SIZE, offset, offset)) > 0:
+                    offset += copied
+            except OSError as error:
+                if error.errno not in _KERNEL_COPY_FALLBACK_ERRORS:
+                    raise
+
+            if offset == size:
+                return
+
+        if hasattr(os, "sendfile"):
+            try:
+                os.lseek(out_fd, offset, os.SEEK_SET)
+
+                while offset < size and (sent := os.sendfile(out_fd, in_fd, offset, _COPY_CHUNK_SIZE)) > 0:
+                    offset += sent
+            except OSError as error:
+                if error.errno not in _KERNEL_COPY_FALLBACK_ERRORS:
+                    raise
+
+            if offset == size:
+                return
+
+        os.lseek(in_fd, offset, os.SEEK_SET)
+        os.lseek(out_fd, offset, os.SEEK_SET)
+
+        free_buffers: queue.Queue = queue.Queue()
+        filled_buffers: queue.Queue = queue.Queue()
+
+        for _ in range(_FALLBACK_BUFFER_COUNT):
+            free_buffers.put(memoryview(bytearray(_FALLBACK_BUFFER_SIZE)))
+
+        with open(in_fd, "rb", buffering=0, closefd=False) as source_file:
+            reader = threading.Thread(target=self.__read_ahead, args=(source_file, free_buffers, filled_buffers), daemon=True)
+            reader.start()
+
+            try:
+                while True:
+                    buffer, read, error = filled_buffers.get()
+
+                    if error is not None:
+                        raise error
+
+                    if read == 0:
+                        break
+
+                    written = 0
+
+                    while written < read:
+                        written += os.write(out_fd, buffer[written:read])
+
+                    offset += read
+                    free_buffers.put(buffer)
+            finally:
+                free_buffers.put(None)
+                reader.join()
+
+        if offset != size:
+            raise OSError(errno.EIO, f"Copied {offset} of {size} bytes")
+
+    def __read_ahead(self, source_file, free_buffers: queue.Queue, filled_buffers: queue.Queue):
+        while (buffer := free_buffers.get()) is not None:
+            try:
+                read = source_file.readinto(buffer)
+            except BaseException as error:
+                filled_buffers.put((buffer, 0, error))
+                return
+
+            filled_buffers.put((buffer, read, None))
+
+            if read == 0:
+                return
 
     def list_contents(self):
-        root_directory = self.__root_directory()
+        source_root = os.path.join(self.source, _ROOT)
+        lines: List[str] = []
+
+        for sub_directory in _SUB_DIRS:
+            source_path = os.path.join(source_root, sub_directory)
+
+            self.__list_contents(source_path, lines, level=1)
 
-        for sub_directory in self.__sub_directories():
-            sub_path = f"{root_directory}/{sub_directory}"
-            source_path = f"{self.source}/{sub_path}"
+        sys.stdout.write("".join(lines))
 
-            self.__list_contents(source_path, level=1)
+    def __list_contents(self, location: str, lines: List[str], level: int = 0):
+        pending = [self.__open_listing(location, lines, level)]
 
-    def __list_contents(self, location: str, level: int = 0):
-        log_prefix = f"{(' ' * 2) * level}"
+        while pending:
+            entries, log_prefix, level = pending[-1]
+            entry = next(entries, None)
 
-        print(f"\n{log_prefix}Listing contents of {location}\n")
+            if entry is None:
+                pending.pop()
+                continue
 
-        for entry in os.scandir(location):
-            entry_name = f"{log_prefix}{entry.name}"
+            if entry.is_file(follow_symlinks=False):
+                if entry.name.endswith(".mp4"):
+                    lines.append(f"{log_prefix}{entry.name} (File)\n")
+            elif entry.is_dir(follow_symlinks=False):
+                lines.append(f"{log_prefix}{entry.name} (Directory)\n")
 
-            if entry.is_file() and entry.name.endswith(".mp4"):
-                print(f"{entry_name} (File)")
-            if entry.is_dir():
-                print(f"{entry_name} (Directory)")
+                pending.append(self.__open_listing(entry.path, lines, level + 1))
 
-                self.__list_contents(entry.path, level + 1)
+    def __open_listing(self, location: str, lines: List[str], level: int) -> Tuple[Iterator[os.DirEntry], str, int]:
+        log_prefix = _INDENTS[level] if level < len(_INDENTS) else "  " * level
 
-    def __make_directory_if_not_exist(self, path: str, not_exist_message: str, creation_message: str):
-        if not os.path.exists(path):
+        lines.append(f"\n{log_prefix}Listing contents of {location}\n\n")
+
+        return iter(self.__scan(location)), log_prefix, level
+
+    def __scan(self, path: str) -> List[os.DirEntry]:
+        with os.scandir(path) as iterator:
+            return list(iterator)
+
+    def __source_directory_exists(self, path: str, not_exist_message: str) -> bool:
+        try:
+            os.stat(path)
+        except FileNotFoundError:
             if not_exist_message is not None:
                 print(not_exist_message)
             else:
                 print(f"Directory {path} does not exist")
 
-            os.mkdir(path)
+            return False
 
-            if creation_message is not None:
-                print(creation_message)
-            else:
-                print(f"Created directory {path}")
+        return True
 
-    def __sub_directories(self) -> List[str]:
-        return [
-            "RecentClips",
-            "SavedClips",
-            "SentryClips",
-        ]
+    def __ensure_destination_directory(self, path: str, creation_message: str):
+        try:
+            os.makedirs(path)
+        except FileExistsError:
+            return
 
-    def __root_directory(self) -> str:
-        return "TeslaCam"
+        if creation_message is not None:
+            print(creation_message)
+        else:
+            print(f"Created directory {path}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Backup Tesla Dashcam")
     parser.add_argument("--list-only", "-l", help="List devices and directories pending copy from source device(s).", action="store_true")
     parser.add_argument("--destination", "-d", help="Destination directory.")
     parser.add_argument("--verbose", "-v", help="Verbose additional info. Default, disabled.", action="store_true")
+    parser.add_argument("--use-cp", help="Copy each clip directory with the system cp instead of the built-in copy. Copies every entry, ignoring the clip suffix filter and the already backed up check. Default, disabled.", action="store_true")
     args = parser.parse_args()
 
     system_mount: str
     destination: str = args.destination
     verbose: bool = args.verbose if args.verbose is not None else False
     should_display_list: bool = args.list_only if args.list_only is not None else False
+    use_cp: bool = args.use_cp if args.use_cp is not None else False
 
     if destination is None:
         print("Destination is required")
@@ -158,14 +477,13 @@ if __name__ == "__main__":
         system_path = Path(system_mount)
 
         source_directories = [
-            item_path for item_path in system_path.iterdir()
+            item_path for item_path in system_path.glob("TESLADRIVE*")
             if item_path.is_dir()
-            if item_path.name.startswith("TESLADRIVE")
         ]
 
         for source_directory in source_directories:
             absolute_path = source_directory.absolute().as_posix()
-            dashcam = DashcamBackup(source=absolute_path, destination=destination, verbose=verbose)
+            dashcam = DashcamBackup(source=absolute_path, destination=destination, verbose=verbose, use_cp=use_cp)
 
             print(f"Checking directory: {absolute_path}")
             print(f"Directory: {absolute_path} is a Tesla Drive")